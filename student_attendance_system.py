@@ -1,13 +1,59 @@
 # recognize_and_attendance.
 import cv2
 import pickle
+import bisect
 import csv
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import os
+import queue
+import threading
+import numpy as np
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+# 不明な顔のラベル（label_mapに存在しないので "不明_000" になる）
+UNKNOWN_LABEL = -1
+
+# MobileFaceNetの入力サイズ
+EMBEDDING_INPUT_SIZE = (112, 112)
+
+
+def preprocess_face_for_embedding(face_bgr, out=None):
+    """BGRの顔画像をMobileFaceNetの入力形式 (3, 112, 112)（RGB順）に変換
+
+    outを渡すとバッチ配列の該当スライスに直接書き込む
+    """
+    face = cv2.resize(face_bgr, EMBEDDING_INPUT_SIZE, interpolation=cv2.INTER_LINEAR)
+    face = cv2.cvtColor(face, cv2.COLOR_BGR2RGB)
+    if out is None:
+        out = np.empty((3,) + face.shape[:2], np.float32)
+    np.subtract(face.transpose(2, 0, 1), 127.5, out=out, dtype=np.float32)
+    out /= 128.0
+    return out
+
 
 class StudentAttendanceSystem:
+    # (不明か, 出席済みか) -> (色, ステータス表示)
+    _STATUS_TABLE = {
+        (True, False): ((0, 0, 255), "不明"),        # 赤: 不明
+        (True, True): ((0, 0, 255), "不明"),
+        (False, True): ((0, 255, 255), "出席済み"),  # 黄: 既に出席済み
+        (False, False): ((0, 255, 0), "認識"),       # 緑: 認識成功
+    }
+    
     def __init__(self, model_path="face_model.yml", labels_path="labels.pkl", 
-                 confidence_threshold=100, attendance_file="attendance.csv"):
+                 confidence_threshold=100, attendance_file="attendance.csv",
+                 embedding_model_path="mobilefacenet_int8.onnx", gallery_path="gallery.npz",
+                 similarity_threshold=0.5, detector_model_path="face_detection_yunet_2023mar.onnx"):
         """
         学生出席認識システム
         
@@ -16,30 +62,78 @@ class StudentAttendanceSystem:
             labels_path: ラベルマップのパス
             confidence_threshold: 認識の信頼度閾値（低いほど厳格）
             attendance_file: 出席記録ファイル
+            embedding_model_path: int8量子化MobileFaceNet (ONNX) のパス
+            gallery_path: 学生ごとの顔埋め込みギャラリーのパス
+            similarity_threshold: 埋め込み認識のコサイン類似度閾値（高いほど厳格）
+            detector_model_path: YuNet顔検出モデル (ONNX) のパス
         """
         self.model_path = model_path
         self.labels_path = labels_path
         self.confidence_threshold = confidence_threshold
         self.attendance_file = attendance_file
+        self.embedding_model_path = embedding_model_path
+        self.gallery_path = gallery_path
+        self.similarity_threshold = similarity_threshold
+        self.detector_model_path = detector_model_path
         
         # 今日の出席セット
         self.today_attendance = set()
+        self._sorted_attendance = []  # 一覧表示用（常にソート済みで保持）
         
         # 認識バッファ（安定した認識のため）
         self.recognition_buffer = {}
         self.buffer_threshold = 3  # 連続認識回数
         
+        # 顔検出は縮小画像で行う（検出コストは画素数に比例）
+        self.detection_scale = 0.5
+        self._gray_small = None
+        
+        # 顔検出はNフレームごと、その間はトラッカーで追跡
+        self.detect_interval = 5
+        self.frame_idx = 0
+        self.trackers = []
+        
+        # 顔の追跡ID（IoUでフレーム間の顔を対応付け、認識バッファのキーにする）
+        self._tracks = []  # (track_id, bbox, last_seen)
+        self._next_track_id = 0
+        self.track_iou_threshold = 0.3
+        self.track_ttl = 15  # 見失ってから追跡IDを破棄するまでのフレーム数
+        
+        # 安定認識済みの顔のキャッシュ（一定フレームは認識をスキップ）
+        self._recent = {}
+        self.recent_ttl = 15  # 再認識までのフレーム数
+        
+        # 出席者数表示の描画キャッシュ (人数, 画像, マスク)
+        self._info_cached = None
+        
+        # 顔ごとの表示テキストと文字幅のキャッシュ (name_id -> (テキスト, 幅))
+        self._text_size_cache = {}
+        
         self.setup_system()
     
     def setup_system(self):
         """システムの初期化"""
         try:
+            # OpenCVのSIMD最適化を有効にし、スレッド数をコア数の半分に制限
+            # （残りは取得スレッドと認識スレッドプール用）
+            cv2.setUseOptimized(True)
+            cv2.setNumThreads(max(1, (os.cpu_count() or 1) // 2))
+            
+            # OpenCLが使えれば色変換と顔検出をT-API (UMat) でGPUに任せる
+            self.use_opencl = cv2.ocl.haveOpenCL()
+            cv2.ocl.setUseOpenCL(self.use_opencl)
+            
             # モデルとラベルの読み込み
             self.load_model_and_labels()
             
             # カメラと顔検出器の初期化
             self.setup_camera()
             
+            # 複数の顔を並列に認識するスレッドプール（LBPHのpredictはGILを解放する）
+            # OpenCVに割り当てたスレッドを除いた残りのコアを使う
+            workers = max(1, (os.cpu_count() or 1) - cv2.getNumThreads())
+            self._pool = ThreadPoolExecutor(max_workers=workers)
+            
             # 今日の出席状況を読み込み
             self.load_today_attendance()
             
@@ -54,38 +148,127 @@ class StudentAttendanceSystem:
     
     def load_model_and_labels(self):
         """モデルとラベルマップの読み込み"""
-        if not os.path.exists(self.model_path):
-            raise FileNotFoundError(f"モデルファイルが見つかりません: {self.model_path}")
-        
         if not os.path.exists(self.labels_path):
             raise FileNotFoundError(f"ラベルファイルが見つかりません: {self.labels_path}")
         
-        # モデル読み込み
-        self.model = cv2.face.LBPHFaceRecognizer_create()
-        self.model.read(self.model_path)
-        
         # ラベルマップ読み込み
         with open(self.labels_path, "rb") as f:
             self.label_map = pickle.load(f)
         
+        # CNN埋め込みモデルが利用可能ならLBPHより優先
+        self.load_embedding_model()
+        
+        if self.session is None:
+            if not os.path.exists(self.model_path):
+                raise FileNotFoundError(f"モデルファイルが見つかりません: {self.model_path}")
+            
+            # モデル読み込み
+            self.model = cv2.face.LBPHFaceRecognizer_create()
+            self.model.read(self.model_path)
+        
         print(f"📚 {len(self.label_map)}人の学生データを読み込みました")
     
+    def load_embedding_model(self):
+        """CNN顔埋め込みモデルとギャラリーの読み込み（利用可能な場合のみ）"""
+        self.session = None
+        if ort is None:
+            return
+        if not (os.path.exists(self.embedding_model_path) and os.path.exists(self.gallery_path)):
+            return
+        
+        # ギャラリーの学生がlabels.pklと一致しなければ古いギャラリーとみなして使わない
+        gallery = np.load(self.gallery_path)
+        label_by_name = {name_id: label for label, name_id in self.label_map.items()}
+        gallery_names = [str(name_id) for name_id in gallery["names"]] if "names" in gallery.files else []
+        if set(gallery_names) != set(label_by_name):
+            print(f"警告: {self.gallery_path} が {self.labels_path} と一致しません。"
+                  f"train_model.py を再実行してください（LBPHを使用します）")
+            return
+        
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(self.embedding_model_path, sess_options=options,
+                                            providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        self._embed_batch = None  # 入力バッチ用バッファ（必要に応じて拡張）
+        
+        # L2正規化済みの埋め込み行列を事前に用意
+        embeddings = gallery["embeddings"].astype(np.float32)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        self.gallery = embeddings / np.maximum(norms, 1e-12)
+        self.gallery_labels = np.array([label_by_name[name_id] for name_id in gallery_names])
+        
+        print(f"🧠 CNN埋め込みモデルを使用します: {self.embedding_model_path}")
+    
     def setup_camera(self):
         """カメラと顔検出器の初期化"""
         self.cap = cv2.VideoCapture(0)
         if not self.cap.isOpened():
             raise RuntimeError("カメラを開けません")
         
-        # カメラ設定
+        # カメラ設定（MJPGはサイズ指定より先に設定しないと無視するドライバがある）
+        self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
+        self.cap.set(cv2.CAP_PROP_FPS, 30)
         self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
         self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
+        self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)  # 古いフレームを溜めない
+        
+        # フレームごとの確保を避けるための作業バッファ
+        self._gray = np.empty((480, 640), np.uint8)
+        self._face_bufs = [np.empty((200, 200), np.uint8)]  # 顔ごとに1つ
         
-        # 顔検出器
-        cascade_path = cv2.data.haarcascades + "haarcascade_frontalface_default.xml"
-        self.detector = cv2.CascadeClassifier(cascade_path)
+        # 顔検出器（YuNetが使えればHaar cascadeより優先）
+        self.use_yunet = hasattr(cv2, "FaceDetectorYN") and os.path.exists(self.detector_model_path)
+        if self.use_yunet:
+            self._yunet_input_size = (320, 240)
+            self.detector = cv2.FaceDetectorYN.create(self.detector_model_path, "",
+                                                      self._yunet_input_size, score_threshold=0.7)
+            print(f"🔍 YuNet顔検出器を使用します: {self.detector_model_path}")
+        else:
+            cascade_path = cv2.data.haarcascades + "haarcascade_frontalface_default.xml"
+            self.detector = cv2.CascadeClassifier(cascade_path)
+            
+            if self.detector.empty():
+                raise RuntimeError("顔検出器の読み込みに失敗しました")
         
-        if self.detector.empty():
-            raise RuntimeError("顔検出器の読み込みに失敗しました")
+        # KCFトラッカー（OpenCVのバージョン差を吸収）
+        # opencv-contribがなく使えない場合は毎フレーム顔検出する
+        if hasattr(cv2, "TrackerKCF_create"):
+            self._create_tracker = cv2.TrackerKCF_create
+        elif hasattr(cv2, "legacy") and hasattr(cv2.legacy, "TrackerKCF_create"):
+            self._create_tracker = cv2.legacy.TrackerKCF_create
+        else:
+            self._create_tracker = None
+            self.detect_interval = 1
+            print("警告: KCFトラッカーが使えないため毎フレーム顔検出します")
+        
+        # フレーム取得スレッド（最新の1フレームだけを保持）
+        self._frame_q = queue.Queue(maxsize=1)
+        self._capture_stop = threading.Event()
+        self._capture_thread = threading.Thread(target=self._capture_loop, daemon=True)
+        self._capture_thread.start()
+    
+    def _capture_loop(self):
+        """カメラからフレームを読み続け、古いフレームは破棄する
+
+        read()と同時にrelease()しないよう、カメラの解放はこのスレッドで行う
+        """
+        try:
+            while not self._capture_stop.is_set():
+                ret, frame = self.cap.read()
+                if not ret:
+                    frame = None  # 読み込み失敗をメインループに通知
+                
+                try:
+                    self._frame_q.get_nowait()
+                except queue.Empty:
+                    pass
+                self._frame_q.put(frame)
+                
+                if frame is None:
+                    break
+        finally:
+            self.cap.release()
     
     def setup_attendance_file(self):
         """出席ファイルの準備"""
@@ -93,6 +276,11 @@ class StudentAttendanceSystem:
             with open(self.attendance_file, "w", newline="", encoding="utf-8") as f:
                 writer = csv.writer(f)
                 writer.writerow(["日付", "時刻", "名前", "学籍番号", "信頼度"])
+        
+        # 記録ごとに開き直さないよう追記用ハンドルを開いたままにする
+        self._att_fh = open(self.attendance_file, "a", newline="", encoding="utf-8",
+                            buffering=1 << 14)
+        self._att_writer = csv.writer(self._att_fh)
     
     def load_today_attendance(self):
         """今日の出席状況を読み込み"""
@@ -101,18 +289,30 @@ class StudentAttendanceSystem:
         
         if os.path.exists(self.attendance_file):
             try:
-                with open(self.attendance_file, "r", encoding="utf-8") as f:
-                    reader = csv.reader(f)
-                    next(reader, None)  # ヘッダーをスキップ
-                    for row in reader:
-                        if len(row) >= 4 and row[0] == today:
-                            name_id = f"{row[2]}_{row[3]}"
-                            self.today_attendance.add(name_id)
+                if pd is not None:
+                    # pandasのCパーサーとベクトル演算で一括抽出
+                    df = pd.read_csv(self.attendance_file, usecols=["日付", "名前", "学籍番号"],
+                                     dtype=str, keep_default_na=False, encoding="utf-8")
+                    mask = df["日付"].values == today
+                    today_rows = df.loc[mask]
+                    self.today_attendance = set(
+                        (today_rows["名前"] + "_" + today_rows["学籍番号"]).tolist()
+                    )
+                else:
+                    with open(self.attendance_file, "r", encoding="utf-8") as f:
+                        reader = csv.reader(f)
+                        next(reader, None)  # ヘッダーをスキップ
+                        for row in reader:
+                            if len(row) >= 4 and row[0] == today:
+                                name_id = f"{row[2]}_{row[3]}"
+                                self.today_attendance.add(name_id)
                 
                 print(f"📋 本日の出席者: {len(self.today_attendance)}人")
                 
             except Exception as e:
                 print(f"警告: 既存の出席データの読み込みに失敗: {e}")
+        
+        self._sorted_attendance = sorted(self.today_attendance)
     
     def parse_name_id(self, name_id):
         """name_studentID形式から名前と学籍番号を分離"""
@@ -137,12 +337,12 @@ class StudentAttendanceSystem:
             time_str = current_time.strftime("%H:%M:%S")
             
             # CSVに記録
-            with open(self.attendance_file, "a", newline="", encoding="utf-8") as f:
-                writer = csv.writer(f)
-                writer.writerow([date_str, time_str, name, student_id, f"{confidence:.1f}"])
+            self._att_writer.writerow([date_str, time_str, name, student_id, f"{confidence:.1f}"])
+            self._att_fh.flush()  # 'r'キーでのリロードにも反映されるように
             
             # 今日の出席セットに追加
             self.today_attendance.add(name_id)
+            bisect.insort(self._sorted_attendance, name_id)
             
             print(f"✅ 出席記録: {name}（学籍番号: {student_id}）- 信頼度: {confidence:.1f}")
             return True
@@ -151,56 +351,267 @@ class StudentAttendanceSystem:
             print(f"❌ 出席記録エラー: {e}")
             return False
     
-    def update_recognition_buffer(self, face_id, name_id, confidence):
+    def update_recognition_buffer(self, face_id, label, confidence):
         """認識バッファの更新（安定した認識のため）"""
         if face_id not in self.recognition_buffer:
-            self.recognition_buffer[face_id] = []
-        
-        self.recognition_buffer[face_id].append((name_id, confidence))
+            # ラベルと信頼度を別々の配列で持つリングバッファ
+            self.recognition_buffer[face_id] = {
+                "labels": np.empty(self.buffer_threshold, np.int32),
+                "confidences": np.empty(self.buffer_threshold, np.float32),
+                "count": 0,
+            }
+        buffer = self.recognition_buffer[face_id]
         
-        # バッファサイズを制限
-        if len(self.recognition_buffer[face_id]) > self.buffer_threshold:
-            self.recognition_buffer[face_id].pop(0)
+        index = buffer["count"] % self.buffer_threshold
+        buffer["labels"][index] = label
+        buffer["confidences"][index] = confidence
+        buffer["count"] += 1
         
         # 安定した認識をチェック
-        if len(self.recognition_buffer[face_id]) >= self.buffer_threshold:
-            # 最も多く認識された名前を取得
-            names = [item[0] for item in self.recognition_buffer[face_id]]
-            most_common_name = max(set(names), key=names.count)
+        if buffer["count"] >= self.buffer_threshold:
+            # 最も多く認識されたラベルを取得（不明の-1を0にずらして集計）
+            counts = np.bincount(buffer["labels"] - UNKNOWN_LABEL)
+            winner = int(counts.argmax()) + UNKNOWN_LABEL
             
-            # 同じ名前が閾値以上認識された場合
-            if names.count(most_common_name) >= self.buffer_threshold - 1:
-                avg_confidence = sum(item[1] for item in self.recognition_buffer[face_id] 
-                                   if item[0] == most_common_name) / names.count(most_common_name)
-                return most_common_name, avg_confidence
+            # 同じラベルが閾値以上認識された場合
+            if counts.max() >= self.buffer_threshold - 1:
+                avg_confidence = float(buffer["confidences"][buffer["labels"] == winner].mean())
+                return winner, avg_confidence
         
         return None, None
     
+    def detect_faces(self, frame, gray, gray_u=None):
+        """縮小画像で顔検出し、元解像度の (x, y, w, h) を返す
+
+        YuNet使用時はカラー画像、Haar cascade使用時はグレースケール画像で検出する
+        """
+        if self.use_yunet:
+            return self.detect_faces_yunet(frame)
+        
+        height, width = gray.shape[:2]
+        small_size = (int(width * self.detection_scale), int(height * self.detection_scale))
+        
+        if gray_u is not None:
+            # OpenCL使用時はGPU上で縮小してそのまま検出
+            gray_small = cv2.resize(gray_u, small_size, interpolation=cv2.INTER_AREA)
+        else:
+            # 縮小用バッファはサイズが変わった時だけ確保
+            if self._gray_small is None or self._gray_small.shape[::-1] != small_size:
+                self._gray_small = np.empty(small_size[::-1], np.uint8)
+            gray_small = cv2.resize(gray, small_size, dst=self._gray_small,
+                                    interpolation=cv2.INTER_AREA)
+        
+        min_size = int(50 * self.detection_scale)
+        faces = self.detector.detectMultiScale(gray_small, 1.2, 5, minSize=(min_size, min_size))
+        
+        scale = 1.0 / self.detection_scale
+        return [tuple(int(v * scale) for v in face) for face in faces]
+    
+    def detect_faces_yunet(self, frame):
+        """縮小したカラー画像をYuNetで顔検出し、元解像度の (x, y, w, h) を返す"""
+        height, width = frame.shape[:2]
+        small_size = (int(width * self.detection_scale), int(height * self.detection_scale))
+        frame_small = cv2.resize(frame, small_size, interpolation=cv2.INTER_AREA)
+        
+        if self._yunet_input_size != small_size:
+            self.detector.setInputSize(small_size)
+            self._yunet_input_size = small_size
+        
+        _, detections = self.detector.detect(frame_small)
+        if detections is None:
+            return []
+        
+        faces = []
+        scale = 1.0 / self.detection_scale
+        for detection in detections:
+            x, y, w, h = (v * scale for v in detection[:4])
+            
+            # YuNetの枠はフレーム外にはみ出すことがあるので切り詰める
+            face = self.clip_box(x, y, w, h, width, height)
+            if face is not None:
+                faces.append(face)
+        return faces
+    
+    @staticmethod
+    def clip_box(x, y, w, h, frame_w, frame_h):
+        """(x, y, w, h) をフレーム内に切り詰める（何も残らなければNone）"""
+        x1, y1 = max(int(x), 0), max(int(y), 0)
+        x2, y2 = min(int(x + w), frame_w), min(int(y + h), frame_h)
+        if x2 <= x1 or y2 <= y1:
+            return None
+        return (x1, y1, x2 - x1, y2 - y1)
+    
+    def init_trackers(self, frame, faces):
+        """検出結果でトラッカーを作り直す"""
+        self.trackers = []
+        if self._create_tracker is None:
+            return
+        for (x, y, w, h) in faces:
+            tracker = self._create_tracker()
+            tracker.init(frame, (x, y, w, h))
+            self.trackers.append(tracker)
+    
+    def update_trackers(self, frame):
+        """トラッカーで顔位置を更新し、追跡に失敗したものは破棄"""
+        frame_h, frame_w = frame.shape[:2]
+        faces = []
+        trackers = []
+        for tracker in self.trackers:
+            ok, (x, y, w, h) = tracker.update(frame)
+            if not ok:
+                continue
+            
+            # フレーム外にはみ出した部分を切り詰める
+            face = self.clip_box(x, y, w, h, frame_w, frame_h)
+            if face is None:
+                continue
+            
+            faces.append(face)
+            trackers.append(tracker)
+        
+        self.trackers = trackers
+        return faces
+    
+    @staticmethod
+    def iou(box_a, box_b):
+        """2つの (x, y, w, h) のIoU"""
+        ax, ay, aw, ah = box_a
+        bx, by, bw, bh = box_b
+        inter_w = min(ax + aw, bx + bw) - max(ax, bx)
+        inter_h = min(ay + ah, by + bh) - max(ay, by)
+        if inter_w <= 0 or inter_h <= 0:
+            return 0.0
+        inter = inter_w * inter_h
+        return inter / float(aw * ah + bw * bh - inter)
+    
+    def assign_track_ids(self, faces):
+        """IoUの高い組から順に既存の追跡IDを割り当て、残りの顔には新しいIDを振る"""
+        pairs = sorted(((self.iou(face, bbox), i, track_id)
+                        for i, face in enumerate(faces)
+                        for track_id, bbox, _ in self._tracks), reverse=True)
+        
+        track_ids = [None] * len(faces)
+        used = set()
+        for overlap, i, track_id in pairs:
+            if overlap < self.track_iou_threshold:
+                break
+            if track_ids[i] is None and track_id not in used:
+                track_ids[i] = track_id
+                used.add(track_id)
+        
+        for i in range(len(faces)):
+            if track_ids[i] is None:
+                track_ids[i] = self._next_track_id
+                self._next_track_id += 1
+        
+        # 追跡情報を更新し、しばらく見えていない顔は破棄
+        tracks = [(track_id, face, self.frame_idx) for track_id, face in zip(track_ids, faces)]
+        tracks += [track for track in self._tracks
+                   if track[0] not in used and self.frame_idx - track[2] < self.track_ttl]
+        self._tracks = tracks
+        
+        # 破棄した顔の認識バッファとキャッシュも削除
+        alive = {track[0] for track in self._tracks}
+        self.recognition_buffer = {track_id: buffer for track_id, buffer
+                                   in self.recognition_buffer.items() if track_id in alive}
+        self._recent = {track_id: entry for track_id, entry in self._recent.items()
+                        if track_id in alive}
+        return track_ids
+    
+    def is_recent_fresh(self, track_id):
+        """キャッシュが有効期限内か"""
+        if track_id not in self._recent:
+            return False
+        return self.frame_idx - self._recent[track_id]["recognized_at"] < self.recent_ttl
+    
+    def remember_recent(self, track_id, label, confidence):
+        """安定認識の結果をキャッシュに保存"""
+        self._recent[track_id] = {"label": label, "confidence": confidence,
+                                  "recognized_at": self.frame_idx}
+        
+        # 期限切れ後の再認識が新しい予測だけで投票されるようバッファを空にする
+        self.recognition_buffer.pop(track_id, None)
+    
+    def recognize_faces(self, frame, gray, faces):
+        """検出された全ての顔を認識し、(label, confidence) のリストを返す"""
+        if len(faces) == 0:
+            return []
+        
+        if self.session is not None:
+            return self.recognize_faces_embedding(frame, faces)
+        
+        # 並列推論でバッファを共有しないよう顔ごとに別のバッファを使う
+        while len(self._face_bufs) < len(faces):
+            self._face_bufs.append(np.empty((200, 200), np.uint8))
+        rois = [cv2.resize(gray[y:y+h, x:x+w], (200, 200), dst=face_buf,
+                           interpolation=cv2.INTER_LINEAR)
+                for (x, y, w, h), face_buf in zip(faces, self._face_bufs)]
+        
+        # 学習時と同じヒストグラム平坦化を適用
+        for roi in rois:
+            cv2.equalizeHist(roi, dst=roi)
+        
+        if len(rois) > 1:
+            predictions = list(self._pool.map(self.model.predict, rois))
+        else:
+            predictions = [self.model.predict(rois[0])]
+        
+        results = []
+        for label, confidence in predictions:
+            # 信頼度チェック
+            if confidence > self.confidence_threshold or label not in self.label_map:
+                label = UNKNOWN_LABEL
+            
+            results.append((label, confidence))
+        return results
+    
+    def recognize_faces_embedding(self, frame, faces):
+        """CNN埋め込みによる一括認識
+
+        信頼度はLBPHと同じく低いほど良い距離として (1 - コサイン類似度)×100 を返す
+        """
+        # 全ての顔を1つの (N, 3, 112, 112) バッチに直接書き込み、推論は1回だけ
+        if self._embed_batch is None or len(self._embed_batch) < len(faces):
+            self._embed_batch = np.empty((len(faces), 3) + EMBEDDING_INPUT_SIZE[::-1], np.float32)
+        batch = self._embed_batch[:len(faces)]
+        for (x, y, w, h), face_input in zip(faces, batch):
+            preprocess_face_for_embedding(frame[y:y+h, x:x+w], out=face_input)
+        embeddings = self.session.run(None, {self.input_name: batch})[0]
+        embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        
+        # ギャラリーとのコサイン類似度を1回の行列積で計算
+        scores = embeddings @ self.gallery.T
+        best = scores.argmax(axis=1)
+        similarities = scores[np.arange(len(best)), best]
+        
+        results = []
+        for index, similarity in zip(best, similarities):
+            label = int(self.gallery_labels[index])
+            if similarity < self.similarity_threshold or label not in self.label_map:
+                label = UNKNOWN_LABEL
+            results.append((label, (1.0 - float(similarity)) * 100))
+        return results
+    
     def draw_face_info(self, frame, x, y, w, h, name_id, confidence, is_present=False):
         """顔情報の描画"""
-        name, student_id = self.parse_name_id(name_id)
-        
-        # 色の設定
-        if name_id == "不明_000":
-            color = (0, 0, 255)  # 赤: 不明
-            status_text = "不明"
-        elif is_present:
-            color = (0, 255, 255)  # 黄: 既に出席済み
-            status_text = "出席済み"
-        else:
-            color = (0, 255, 0)  # 緑: 認識成功
-            status_text = "認識"
+        # 色とステータスの設定
+        color, status_text = self._STATUS_TABLE[(name_id == "不明_000", bool(is_present))]
         
         # 顔の枠を描画
         cv2.rectangle(frame, (x, y), (x+w, y+h), color, 2)
         
-        # テキスト情報
-        main_text = f"{name}({student_id})"
+        # テキスト情報（文字幅は同じ学生なら変わらないのでキャッシュ）
+        cached = self._text_size_cache.get(name_id)
+        if cached is None:
+            name, student_id = self.parse_name_id(name_id)
+            main_text = f"{name}({student_id})"
+            text_width = cv2.getTextSize(main_text, cv2.FONT_HERSHEY_SIMPLEX, 0.7, 2)[0][0]
+            cached = self._text_size_cache[name_id] = (main_text, text_width)
+        main_text, text_width = cached
         conf_text = f"信頼度: {confidence:.1f}"
         
         # テキストの背景
-        text_size = cv2.getTextSize(main_text, cv2.FONT_HERSHEY_SIMPLEX, 0.7, 2)[0]
-        cv2.rectangle(frame, (x, y-60), (x + max(text_size[0], 200), y), color, -1)
+        cv2.rectangle(frame, (x, y-60), (x + max(text_width, 200), y), color, -1)
         
         # メインテキスト
         cv2.putText(frame, main_text, (x+5, y-35), 
@@ -214,46 +625,90 @@ class StudentAttendanceSystem:
         cv2.putText(frame, status_text, (x, y+h+20), 
                    cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
     
+    def draw_info_overlay(self, frame):
+        """出席者数の表示（人数が変わった時だけ文字を描き直す）"""
+        count = len(self.today_attendance)
+        if self._info_cached is None or self._info_cached[0] != count:
+            overlay = np.zeros((40, 400, 3), np.uint8)
+            info_text = f"本日の出席者: {count}人"
+            cv2.putText(overlay, info_text, (10, 30), 
+                       cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 2)
+            mask = overlay.any(axis=2, keepdims=True)  # 文字の画素だけ上書き
+            self._info_cached = (count, overlay, mask)
+        
+        _, overlay, mask = self._info_cached
+        
+        # フレームが40x400より小さい場合ははみ出す部分を切り捨てる
+        roi = frame[0:40, 0:400]
+        height, width = roi.shape[:2]
+        np.copyto(roi, overlay[:height, :width], where=mask[:height, :width])
+    
     def run(self):
         """メインループの実行"""
         print("🟢 出席認識開始... 'q'キーで終了, 'r'キーで出席状況リロード, 's'キーで出席者一覧表示")
         
         try:
             while True:
-                ret, frame = self.cap.read()
-                if not ret:
+                try:
+                    frame = self._frame_q.get(timeout=1.0)
+                except queue.Empty:
+                    # 最初のフレームは時間がかかることがあるので、取得スレッドが動いていれば待つ
+                    if self._capture_thread.is_alive():
+                        continue
+                    frame = None
+                if frame is None:
                     print("❌ カメラからの読み込みに失敗")
                     break
                 
-                # グレースケール変換
-                gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+                # グレースケール変換（UMatはHaar cascadeでの検出にしか使わない）
+                if self.use_opencl and not self.use_yunet:
+                    gray_u = cv2.cvtColor(cv2.UMat(frame), cv2.COLOR_BGR2GRAY)
+                    gray = gray_u.get()  # 顔領域の切り出し用にホストへ1回だけ転送
+                else:
+                    # （解像度が異なる場合はOpenCVが新しい配列を返す）
+                    gray_u = None
+                    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self._gray)
+                
+                # 顔検出（Nフレームごと、それ以外はトラッカーで追跡）
+                if self.frame_idx % self.detect_interval == 0:
+                    faces = self.detect_faces(frame, gray, gray_u)
+                    self.init_trackers(frame, faces)
+                else:
+                    faces = self.update_trackers(frame)
+                self.frame_idx += 1
                 
-                # 顔検出
-                faces = self.detector.detectMultiScale(gray, 1.2, 5, minSize=(50, 50))
+                # 追跡IDの割り当て（前フレームと同じ顔には同じID）
+                track_ids = self.assign_track_ids(faces)
+                
+                # 最近安定して認識された顔は認識処理をスキップ
+                fresh = [self.is_recent_fresh(track_id) for track_id in track_ids]
+                
+                # 顔認識（キャッシュにない顔をまとめて処理）
+                pending = [face for face, is_fresh in zip(faces, fresh) if not is_fresh]
+                pending_results = iter(self.recognize_faces(frame, gray, pending))
                 
                 # 各顔を処理
-                for i, (x, y, w, h) in enumerate(faces):
-                    face_roi = gray[y:y+h, x:x+w]
-                    
-                    # 顔認識
-                    face_resized = cv2.resize(face_roi, (200, 200))
-                    label, confidence = self.model.predict(face_resized)
+                for face, track_id, is_fresh in zip(faces, track_ids, fresh):
+                    x, y, w, h = face
+                    if is_fresh:
+                        entry = self._recent[track_id]
+                        label, confidence = entry["label"], entry["confidence"]
+                    else:
+                        label, confidence = next(pending_results)
                     
                     # ラベルから名前_IDを取得
                     name_id = self.label_map.get(label, "不明_000")
                     
-                    # 信頼度チェック
-                    if confidence > self.confidence_threshold:
-                        name_id = "不明_000"
-                    
-                    # 安定した認識をチェック
-                    stable_name_id, stable_confidence = self.update_recognition_buffer(
-                        f"face_{i}", name_id, confidence
-                    )
-                    
-                    # 出席記録（安定した認識のみ）
-                    if stable_name_id and stable_name_id != "不明_000":
-                        self.record_attendance(stable_name_id, stable_confidence)
+                    # 安定した認識をチェック（キャッシュの結果はバッファに入れない）
+                    if not is_fresh:
+                        stable_label, stable_confidence = self.update_recognition_buffer(
+                            track_id, label, confidence
+                        )
+                        
+                        # 出席記録（安定した認識のみ）
+                        if stable_label is not None and stable_label != UNKNOWN_LABEL:
+                            self.record_attendance(self.label_map[stable_label], stable_confidence)
+                            self.remember_recent(track_id, stable_label, stable_confidence)
                     
                     # 表示用の情報
                     display_name_id = name_id
@@ -265,9 +720,7 @@ class StudentAttendanceSystem:
                                       display_confidence, is_present)
                 
                 # 情報表示
-                info_text = f"本日の出席者: {len(self.today_attendance)}人"
-                cv2.putText(frame, info_text, (10, 30), 
-                           cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 2)
+                self.draw_info_overlay(frame)
                 
                 # フレーム表示
                 cv2.imshow("学生出席確認システム", frame)
@@ -298,7 +751,7 @@ class StudentAttendanceSystem:
         if not self.today_attendance:
             print("まだ出席者がいません")
         else:
-            for i, name_id in enumerate(sorted(self.today_attendance), 1):
+            for i, name_id in enumerate(self._sorted_attendance, 1):
                 name, student_id = self.parse_name_id(name_id)
                 print(f"{i:2d}. {name} (学籍番号: {student_id})")
         
@@ -307,8 +760,16 @@ class StudentAttendanceSystem:
     
     def cleanup(self):
         """リソースのクリーンアップ"""
-        if hasattr(self, 'cap') and self.cap:
+        if hasattr(self, '_capture_thread'):
+            # カメラは取得スレッドが終了時に解放する（read()中に止まっていても安全）
+            self._capture_stop.set()
+            self._capture_thread.join(timeout=1.0)
+        elif hasattr(self, 'cap') and self.cap:
             self.cap.release()
+        if hasattr(self, '_pool'):
+            self._pool.shutdown(wait=False)
+        if hasattr(self, '_att_fh'):
+            self._att_fh.close()
         cv2.destroyAllWindows()
         
         # 最終的な出席一覧を表示
@@ -327,7 +788,7 @@ def main():
     except Exception as e:
         print(f"❌ システムの開始に失敗: {e}")
         print("必要なファイルを確認してください:")
-        print("1. face_model.yml (訓練済みモデル)")
+        print("1. face_model.yml (訓練済みモデル)、または mobilefacenet_int8.onnx と gallery.npz")
         print("2. labels.pkl (ラベルマップ)")
         print("3. 動作するWebカメラ")
 
@@ -3,10 +3,72 @@ import cv2
 import os
 import numpy as np
 import pickle
+from concurrent.futures import ThreadPoolExecutor
+from student_attendance_system import ort, preprocess_face_for_embedding
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+embedding_model_path = 'mobilefacenet_int8.onnx'
+build_gallery = ort is not None and os.path.exists(embedding_model_path)
+face_size = (200, 200)  # 認識時のリサイズと同じサイズ
+
+
+def equalize_batch(batch):
+    """(N, H, W) の画像バッチを1枚ずつヒストグラム平坦化"""
+    out = np.empty_like(batch)
+    n, height, width = batch.shape
+    total = height * width
+    for i in prange(n):
+        hist = np.zeros(256, np.int64)
+        for y in range(height):
+            for x in range(width):
+                hist[batch[i, y, x]] += 1
+
+        cdf = np.cumsum(hist)
+        cdf_min = 0
+        for v in range(256):
+            if hist[v] > 0:
+                cdf_min = cdf[v]
+                break
+
+        lut = np.empty(256, np.uint8)
+        for v in range(256):
+            if total == cdf_min:
+                lut[v] = v  # 単色画像はそのまま
+            else:
+                lut[v] = min(255, max(0, int(round((cdf[v] - cdf_min) * 255.0 / (total - cdf_min)))))
+
+        for y in range(height):
+            for x in range(width):
+                out[i, y, x] = lut[batch[i, y, x]]
+    return out
+
+
+def load_face(image_path):
+    """画像を読み込み、(サイズを揃えたグレースケール, カラー) を返す（読み込めなければNone）
+
+    カラー画像はギャラリー作成時のみ保持する
+    """
+    img = cv2.imread(image_path, cv2.IMREAD_COLOR)
+    if img is None:
+        return None
+    # バッチを3次元配列にするためサイズを揃える
+    gray = cv2.resize(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), face_size)
+    return gray, (img if build_gallery else None)
+
+
+if njit is not None:
+    preprocess = njit(parallel=True, fastmath=True)(equalize_batch)
+else:
+    def preprocess(batch):
+        return np.stack([cv2.equalizeHist(img) for img in batch])
 
 data_path = 'dataset'
-faces = []
-labels = []
+image_paths = []
+image_labels = []
 label_map = {}
 label_count = 0
 
@@ -18,19 +80,56 @@ for person_name in os.listdir(data_path):
 
     label_map[label_count] = person_name  # 例: "田中_001"
     for image_name in os.listdir(person_path):
-        image_path = os.path.join(person_path, image_name)
-        img = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
-        if img is None:
-            continue
-        faces.append(img)
-        labels.append(label_count)
+        image_paths.append(os.path.join(person_path, image_name))
+        image_labels.append(label_count)
 
     label_count += 1
 
+# 画像の読み込みとデコードはスレッドプールで並列に行う（OpenCVはGILを解放する）
+with ThreadPoolExecutor(max_workers=16) as executor:
+    images = list(executor.map(load_face, image_paths))
+
+faces = []
+color_faces = []
+labels = []
+for loaded, label in zip(images, image_labels):
+    if loaded is None:
+        continue
+    gray, color = loaded
+    faces.append(gray)
+    color_faces.append(color)
+    labels.append(label)
+
+# CNN埋め込みモデルがある場合は学生ごとの平均埋め込み（ギャラリー）も作成
+if build_gallery:
+    session = ort.InferenceSession(embedding_model_path, providers=["CPUExecutionProvider"])
+    input_name = session.get_inputs()[0].name
+    embeddings = np.concatenate([
+        session.run(None, {input_name: preprocess_face_for_embedding(face)[np.newaxis]})[0]
+        for face in color_faces
+    ]).astype(np.float32)
+    embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+
+    # ラベル番号はフォルダ順で変わるので、ギャラリーには名前_IDを保存する
+    gallery_labels = np.unique(labels)
+    gallery = np.stack([embeddings[np.array(labels) == label].mean(axis=0)
+                        for label in gallery_labels])
+    gallery_names = np.array([label_map[label] for label in gallery_labels])
+    np.savez("gallery.npz", embeddings=gallery, names=gallery_names)
+    print("✅ gallery.npzを保存しました。")
+elif os.path.exists("gallery.npz"):
+    # 今回のラベルと対応しない古いギャラリーは残さない
+    os.remove("gallery.npz")
+    print("🗑 古いgallery.npzを削除しました。")
+
 # NumPy配列に変換
-faces = np.array(faces)
+faces = np.array(faces, dtype=np.uint8)
 labels = np.array(labels)
 
+# 前処理（ヒストグラム平坦化）を全画像に並列適用
+# （認識時も同じ平坦化を行う）
+faces = preprocess(faces)
+
 # モデル学習
 model = cv2.face.LBPHFaceRecognizer_create()
 model.train(faces, labels)